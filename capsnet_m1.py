@@ -8,21 +8,42 @@ Classes:
     PrimaryCaps: Convolutional layer that produces primary capsules.
     DigitCaps: Capsule layer with dynamic routing, producing class capsules.
     CapsNet: End-to-end capsule network combining the above layers.
+    GraphedCapsNet: Fixed-shape CapsNet inference replayed from a CUDA graph.
+    DeviceBatches: Batch iterator over an MNIST split preloaded on the device.
 
 Functions:
+    squash: Capsule non-linearity shared by both capsule layers.
+    dynamic_routing: Routing-by-agreement between input and class capsules.
     margin_loss: Loss function for training capsule networks.
 
 Usage:
     python capsnet_m1.py  # trains the network on MNIST for a few epochs and prints accuracy.
+    torchrun --nproc_per_node=N capsnet_m1.py  # same, data-parallel across N GPUs.
 """
 
+import os
+from typing import Optional
+
 import torch
+import torch.distributed as dist
 import torch.nn as nn
+import torch.ao.nn.intrinsic as nni
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, DistributedSampler
 from torchvision import datasets, transforms
 
 
+# Scripted once and shared by PrimaryCaps ([B,N,8]) and DigitCaps routing ([B,1,C,16]);
+# the fuser merges the reduction and the element-wise tail on CUDA
+@torch.jit.script
+def squash(s: torch.Tensor, eps: float = 1e-8) -> torch.Tensor:
+    """Non-linear activation that scales vectors to have length between 0 and 1."""
+    # |s|^2 / (1 + |s|^2) * s / |s| folded into a single scale factor
+    sq = (s * s).sum(dim=-1, keepdim=True)
+    return s * (sq / (1.0 + sq) * torch.rsqrt(sq + eps))
+
+
 class PrimaryCaps(nn.Module):
     """Primary capsule layer implemented as a convolution followed by a squash."""
 
@@ -33,55 +54,65 @@ class PrimaryCaps(nn.Module):
         self.caps_dim = caps_dim
         self.n_caps = n_caps
 
-    @staticmethod
-    def squash(s: torch.Tensor, eps: float = 1e-8) -> torch.Tensor:
-        """Non-linear activation that scales vectors to have length between 0 and 1."""
-        norm = torch.sqrt((s ** 2).sum(dim=-1, keepdim=True) + eps)
-        scale = (norm ** 2) / (1.0 + norm ** 2)
-        return scale * (s / (norm + eps))
-
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         # x: [batch, in_channels, H, W] -> [batch, n_caps*H*W, caps_dim]
         u = self.conv(x)
-        B, C, H, W = u.size()
-        u = u.view(B, self.n_caps, self.caps_dim, H, W).permute(0, 3, 4, 1, 2).contiguous()
-        u = u.view(B, -1, self.caps_dim)
-        return self.squash(u)
+        B = u.size(0)
+        # Channels are laid out as (n_caps, caps_dim), so moving them last yields
+        # the same [H, W, n_caps, caps_dim] capsule order with a single reshape;
+        # with channels_last activations the permute is already contiguous and
+        # the reshape is a zero-copy view
+        u = u.permute(0, 2, 3, 1).reshape(B, -1, self.caps_dim)
+        return squash(u)
+
+
+def dynamic_routing(u_hat: torch.Tensor, routing_iters: int) -> torch.Tensor:
+    """Route prediction vectors u_hat [B,N,C,out_dim] to class capsules [B,1,C,out_dim]."""
+    # With all logits b at zero the first softmax over classes is uniform (1/C), so
+    # the first pass needs no softmax; later iterations share one branch-free body
+    s = u_hat.sum(dim=1, keepdim=True) / u_hat.size(2)
+    v = squash(s)
+    b = torch.zeros_like(u_hat[..., :1])
+    for _ in range(routing_iters - 1):
+        b = b + (u_hat * v).sum(dim=-1, keepdim=True)
+        c = F.softmax(b, dim=2)
+        s = (c * u_hat).sum(dim=1, keepdim=True)
+        v = squash(s)
+    return v
+
+
+# Fuses softmax, weighted sum, squash and agreement of every iteration into a
+# few generated kernels so u_hat is streamed once per iteration instead of once per op.
+compiled_dynamic_routing = torch.compile(dynamic_routing, mode="reduce-overhead", fullgraph=True)
 
 
 class DigitCaps(nn.Module):
     """Digit capsule layer with dynamic routing."""
 
     def __init__(self, n_in_caps: int, in_dim: int, n_classes: int = 10,
-                 out_dim: int = 16, routing_iters: int = 3) -> None:
+                 out_dim: int = 16, routing_iters: int = 3,
+                 compile_routing: bool = True) -> None:
         super().__init__()
         self.n_in_caps = n_in_caps
         self.n_classes = n_classes
         self.routing_iters = routing_iters
+        # Only used on CUDA, where inductor emits fused Triton kernels
+        self.compile_routing = compile_routing
         # Transformation matrix for each pair of input and output capsules
         self.W = nn.Parameter(0.01 * torch.randn(1, n_in_caps, n_classes, out_dim, in_dim))
 
-    @staticmethod
-    def squash(s: torch.Tensor, eps: float = 1e-8) -> torch.Tensor:
-        norm = torch.sqrt((s ** 2).sum(dim=-1, keepdim=True) + eps)
-        scale = (norm ** 2) / (1.0 + norm ** 2)
-        return scale * (s / (norm + eps))
-
-    def forward(self, u: torch.Tensor) -> torch.Tensor:
-        # u: [batch, N_in, in_dim]
-        B, N, D = u.size()
-        # Expand transformation matrix to batch dimension
-        W = self.W.repeat(B, 1, 1, 1, 1)
-        # Predict output capsule vectors: [B,N,C,out_dim]
-        u_hat = torch.matmul(W, u.unsqueeze(2).unsqueeze(-1)).squeeze(-1)
-        b = torch.zeros(B, N, self.n_classes, 1, device=u.device)
-        for _ in range(self.routing_iters):
-            c = F.softmax(b, dim=2)
-            s = (c * u_hat).sum(dim=1, keepdim=True)
-            v = self.squash(s)
-            if _ < self.routing_iters - 1:
-                agreement = (u_hat * v).sum(dim=-1, keepdim=True)
-                b = b + agreement
+    def forward(self, u: torch.Tensor, compile_routing: Optional[bool] = None) -> torch.Tensor:
+        # u: [batch, N_in, in_dim]; compile_routing overrides self.compile_routing for this call
+        # Predict output capsule vectors: [B,N,C,out_dim]; W is shared across
+        # the batch, so contract it directly instead of repeating it B times
+        u_hat = torch.einsum('ncod,bnd->bnco', self.W.squeeze(0), u)
+        # Never nest the compiled routing's own cudagraph inside an outer capture
+        if compile_routing is None:
+            compile_routing = self.compile_routing
+        if compile_routing and u_hat.is_cuda and not torch.cuda.is_current_stream_capturing():
+            v = compiled_dynamic_routing(u_hat, self.routing_iters)
+        else:
+            v = dynamic_routing(u_hat, self.routing_iters)
         return v.squeeze(1)  # [batch, C, out_dim]
 
 
@@ -90,8 +121,9 @@ class CapsNet(nn.Module):
 
     def __init__(self, n_classes: int = 10) -> None:
         super().__init__()
-        # Initial conv layer
-        self.stem = nn.Sequential(
+        # Initial conv layer. ConvReLU2d only marks the conv+ReLU pair for fusion
+        # (e.g. by torch.ao quantization's convert); eager mode still runs two kernels
+        self.stem = nni.ConvReLU2d(
             nn.Conv2d(1, 256, kernel_size=9, stride=1), nn.ReLU(inplace=True)
         )
         # Primary capsules: reduces spatial dims and increases channels
@@ -101,14 +133,59 @@ class CapsNet(nn.Module):
         self.digits = DigitCaps(n_in_caps=self.n_in_caps, in_dim=8,
                                n_classes=n_classes, out_dim=16)
 
-    def forward(self, x: torch.Tensor) -> tuple:
+    def forward(self, x: torch.Tensor, compile_routing: Optional[bool] = None) -> tuple:
         x = self.stem(x)
         u = self.primary(x)
-        v = self.digits(u)
+        v = self.digits(u, compile_routing=compile_routing)
         logits = v.norm(dim=-1)
         return logits, v
 
 
+class GraphedCapsNet:
+    """Fixed-shape CapsNet inference replayed from a single captured CUDA graph.
+
+    Every kernel of the forward pass (stem, primary capsules, routing iterations,
+    norm) is launched with one ``graph.replay()``. Parameters are read in place,
+    so the graph keeps tracking the model while it trains. The returned tensors
+    are static buffers overwritten by the next call; inputs of any other shape
+    fall back to the eager model.
+    """
+
+    def __init__(self, model: CapsNet, batch_size: int,
+                 amp_dtype: Optional[torch.dtype] = None, warmup_iters: int = 3) -> None:
+        self.model = model
+        self.amp_dtype = amp_dtype
+        self.static_x = torch.zeros(batch_size, 1, 28, 28, device='cuda').contiguous(
+            memory_format=torch.channels_last)
+        # Warm up on a side stream so cuDNN autotuning and lazy allocations stay out of the capture
+        side = torch.cuda.Stream()
+        side.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side), torch.no_grad():
+            for _ in range(warmup_iters):
+                self._forward(self.static_x, eager_routing=True)
+        torch.cuda.current_stream().wait_stream(side)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph), torch.no_grad():
+            self.static_logits, self.static_v = self._forward(self.static_x, eager_routing=True)
+
+    def _forward(self, x: torch.Tensor, eager_routing: bool = False) -> tuple:
+        # Warmup and capture both force the eager routing, so the warmed-up kernels
+        # and allocations are the ones captured and no compiled cudagraph is nested.
+        # The autocast weight cache is not allowed inside graph capture.
+        with torch.autocast(device_type='cuda', dtype=self.amp_dtype or torch.bfloat16,
+                            enabled=self.amp_dtype is not None, cache_enabled=False):
+            return self.model(x, compile_routing=False if eager_routing else None)
+
+    @torch.no_grad()
+    def __call__(self, x: torch.Tensor) -> tuple:
+        if x.shape != self.static_x.shape:
+            return self._forward(x)
+        self.static_x.copy_(x)
+        self.graph.replay()
+        return self.static_logits, self.static_v
+
+
+@torch.jit.script
 def margin_loss(logits: torch.Tensor, target: torch.Tensor, m_pos: float = 0.9,
                 m_neg: float = 0.1, lambda_: float = 0.5) -> torch.Tensor:
     """Margin loss used in capsule networks.
@@ -123,51 +200,178 @@ def margin_loss(logits: torch.Tensor, target: torch.Tensor, m_pos: float = 0.9,
     Returns:
         Tensor containing the mean margin loss.
     """
-    B, C = logits.shape
-    y = F.one_hot(target, C).float()
-    L_pos = F.relu(m_pos - logits).pow(2)
-    L_neg = F.relu(logits - m_neg).pow(2)
-    L = y * L_pos + lambda_ * (1 - y) * L_neg
+    C = logits.size(1)
+    # Select per class instead of materialising a float one-hot mask
+    present = target.unsqueeze(1) == torch.arange(C, device=logits.device)
+    L_pos = (m_pos - logits).clamp_min(0.0).pow(2)
+    L_neg = (logits - m_neg).clamp_min(0.0).pow(2)
+    L = torch.where(present, L_pos, lambda_ * L_neg)
     return L.sum(dim=1).mean()
 
 
-def train_capsnet(epochs: int = 5, batch_size: int = 128, lr: float = 1e-3) -> None:
-    """Simple training loop for CapsNet on MNIST."""
+class DeviceBatches:
+    """Batch iterator over an MNIST split staged once on the target device.
+
+    MNIST fits in ~50 MB, so on a GPU copying the whole split up front and
+    slicing batches there beats DataLoader workers and per-batch host copies.
+    Yields the same [B,1,28,28] floats in [0, 1] as ``transforms.ToTensor``.
+    With ``world_size > 1`` each rank iterates its own equal-sized shard of a
+    permutation shared by all ranks, like ``DistributedSampler``.
+    """
+
+    def __init__(self, dataset: datasets.MNIST, batch_size: int, shuffle: bool,
+                 device: str, rank: int = 0, world_size: int = 1, seed: int = 0) -> None:
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+        self.x = dataset.data.to(device).unsqueeze(1).float().div_(255.)
+        self.y = dataset.targets.to(device)
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _num_samples(self) -> int:
+        return (len(self.y) + self.world_size - 1) // self.world_size
+
+    def __len__(self) -> int:
+        return (self._num_samples() + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = len(self.y)
+        if self.shuffle and self.world_size > 1:
+            # Same seed on every rank so the shards partition one permutation
+            g = torch.Generator().manual_seed(self.seed + self.epoch)
+            order = torch.randperm(n, generator=g).to(self.y.device)
+        elif self.shuffle:
+            # Single process: global RNG, so every epoch differs and torch.manual_seed applies
+            order = torch.randperm(n, device=self.y.device)
+        else:
+            order = torch.arange(n, device=self.y.device)
+        if self.world_size > 1:
+            # Pad by wrapping so every rank runs the same number of steps
+            padded = self._num_samples() * self.world_size
+            order = torch.cat([order, order[:padded - n]])[self.rank::self.world_size]
+        for start in range(0, len(order), self.batch_size):
+            idx = order[start:start + self.batch_size]
+            yield self.x[idx], self.y[idx]
+
+
+def train_capsnet(epochs: int = 5, batch_size: int = 128, lr: float = 1e-3,
+                  preload: bool = True, amp: bool = True) -> None:
+    """Simple training loop for CapsNet on MNIST.
+
+    With ``preload`` and a CUDA device the datasets are staged on the GPU via
+    ``DeviceBatches``; otherwise pinned, persistent DataLoader workers are used.
+    With ``amp`` on CUDA the forward pass runs under bfloat16 autocast (float16
+    with loss scaling on GPUs without bf16); the margin loss stays in float32.
+
+    Launched through ``torchrun --nproc_per_node=N capsnet_m1.py`` the model is
+    wrapped in DistributedDataParallel (NCCL on CUDA) and every process trains on
+    its own shard; ``batch_size`` is per process and rank 0 evaluates and logs.
+    """
+    distributed = int(os.environ.get('WORLD_SIZE', '1')) > 1
+    if distributed:
+        dist.init_process_group(backend='nccl' if torch.cuda.is_available() else 'gloo')
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        local_rank = int(os.environ['LOCAL_RANK'])
+        if torch.cuda.is_available():
+            # 'cuda' below then refers to this process's GPU
+            torch.cuda.set_device(local_rank)
+    else:
+        rank, world_size, local_rank = 0, 1, 0
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    model = CapsNet().to(device)
+    net = CapsNet().to(device)
+    # NHWC keeps caps_dim innermost for PrimaryCaps and suits Tensor Core convs;
+    # only the 4-D conv weights can take channels_last (DigitCaps.W is 5-D)
+    net.stem.to(memory_format=torch.channels_last)
+    net.primary.to(memory_format=torch.channels_last)
+    model = net
+    if distributed:
+        # ~6.8M fp32 parameters (~27 MB): a 32 MB bucket cap keeps gradient sync to a
+        # couple of all-reduces per step, overlapped with the backward pass
+        model = DDP(net, device_ids=[local_rank] if device == 'cuda' else None, bucket_cap_mb=32)
     optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    use_amp = amp and device == 'cuda'
+    amp_dtype = torch.float16 if use_amp and not torch.cuda.is_bf16_supported() else torch.bfloat16
+    # bf16 shares fp32's exponent range; only fp16 gradients need scaling
+    scaler = torch.amp.GradScaler('cuda', enabled=use_amp and amp_dtype == torch.float16)
+    graphed: Optional[GraphedCapsNet] = None
 
     transform = transforms.Compose([transforms.ToTensor()])
+    # Rank 0 downloads first so the other ranks do not race on ./data
+    if distributed and rank != 0:
+        dist.barrier()
     train_set = datasets.MNIST(root='./data', train=True, download=True, transform=transform)
     test_set = datasets.MNIST(root='./data', train=False, download=True, transform=transform)
-    train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=True, num_workers=4)
-    test_loader = DataLoader(test_set, batch_size=256, shuffle=False, num_workers=4)
+    if distributed and rank == 0:
+        dist.barrier()
+    if preload and device == 'cuda':
+        train_loader = DeviceBatches(train_set, batch_size, shuffle=True, device=device,
+                                     rank=rank, world_size=world_size)
+        test_loader = DeviceBatches(test_set, 256, shuffle=False, device=device)
+    else:
+        # Keep workers alive across epochs and overlap host->device copies with compute
+        loader_kwargs = dict(num_workers=4, pin_memory=device == 'cuda',
+                             persistent_workers=True, prefetch_factor=4)
+        train_sampler = DistributedSampler(train_set) if distributed else None
+        train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=train_sampler is None,
+                                  sampler=train_sampler, **loader_kwargs)
+        test_loader = DataLoader(test_set, batch_size=256, shuffle=False, **loader_kwargs)
 
     for epoch in range(epochs):
+        # Reshuffle the shards differently every epoch
+        if isinstance(train_loader, DeviceBatches):
+            train_loader.set_epoch(epoch)
+        elif distributed:
+            train_sampler.set_epoch(epoch)
         model.train()
-        total_loss = 0.0
+        total_loss, seen = 0.0, 0
         for x, y in train_loader:
-            x, y = x.to(device), y.to(device)
-            logits, _ = model(x)
-            loss = margin_loss(logits, y)
+            x = x.to(device, memory_format=torch.channels_last, non_blocking=True)
+            y = y.to(device, non_blocking=True)
+            with torch.autocast(device_type=device, dtype=amp_dtype, enabled=use_amp):
+                logits, _ = model(x)
+            loss = margin_loss(logits.float(), y)
             optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             total_loss += loss.item() * x.size(0)
-        avg_loss = total_loss / len(train_loader.dataset)
-        # Evaluate accuracy on test set
-        model.eval()
+            seen += x.size(0)
+        if distributed:
+            stats = torch.tensor([total_loss, seen], dtype=torch.float64, device=device)
+            dist.all_reduce(stats)
+            total_loss, seen = stats.tolist()
+        avg_loss = total_loss / seen
+        if rank != 0:
+            continue
+        # Evaluate accuracy on test set (unwrapped model: no gradient sync needed)
+        net.eval()
+        if device == 'cuda' and graphed is None:
+            # Captured once: optimizer steps update the weights the graph reads in place
+            graphed = GraphedCapsNet(net, 256, amp_dtype if use_amp else None)
         correct, total = 0, 0
         with torch.no_grad():
             for x, y in test_loader:
-                x, y = x.to(device), y.to(device)
-                logits, _ = model(x)
+                x = x.to(device, memory_format=torch.channels_last, non_blocking=True)
+                y = y.to(device, non_blocking=True)
+                if graphed is not None:
+                    logits, _ = graphed(x)
+                else:
+                    logits, _ = net(x)
                 preds = logits.argmax(dim=1)
                 correct += (preds == y).sum().item()
                 total += y.size(0)
         acc = correct / total
         print(f"Epoch {epoch+1}: loss={avg_loss:.4f}, accuracy={acc:.4f}")
 
+    if distributed:
+        dist.destroy_process_group()
+
 
 if __name__ == '__main__':
     train_capsnet()
\ No newline at end of file
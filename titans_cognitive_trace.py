@@ -8,10 +8,13 @@ module so that reviewers can follow the "thought" process step by step.
 """
 from __future__ import annotations
 
+import functools
 import math
 import time
+from collections import deque
 from dataclasses import dataclass
-from typing import Dict, Iterable, List, Sequence, Tuple
+from types import MappingProxyType
+from typing import Dict, Iterable, List, Mapping, Sequence, Tuple
 
 try:  # Optional numeric helper for nicer formatting if available
     import numpy as _np
@@ -25,6 +28,19 @@ except ModuleNotFoundError:  # pragma: no cover - optional dependency
 
 
 Vector3 = Tuple[float, float, float]
+# ``(batch, 3)`` float64 ndarray when NumPy is available, a list of Vector3 otherwise
+VectorBatch = Sequence[Vector3]
+
+# Read-only knowledge graph used when networkx is unavailable; tuples can be
+# handed out directly without a defensive copy.
+_KNOWLEDGE_GRAPH: Mapping[str, Tuple[str, ...]] = MappingProxyType(
+    {
+        "CONCEPT_URGENT_TASK": ("ACTION_ALLOCATE_RESOURCES", "NOTIFY_SUPERVISOR"),
+        "CONCEPT_ANALYTICAL_INPUT": ("ACTION_RUN_ANALYSIS",),
+        "ACTION_RUN_ANALYSIS": ("SAVE_RESULTS",),
+    }
+)
+_NOT_FOUND: Tuple[str, ...] = ("No related concepts found.",)
 
 
 def print_header(title: str) -> None:
@@ -40,7 +56,7 @@ def print_io(
     output_label: str,
     output_data: object,
     *,
-    delay_seconds: float,
+    delay_seconds: float = 0.0,
 ) -> None:
     """Print formatted input/output pairs with an optional delay."""
     print(f"  -> Input ({input_label}):\n     {input_data}")
@@ -56,7 +72,7 @@ class CognitiveTraceResult:
     perception_vector: Vector3
     memory_status: str
     abstract_concept: str
-    related_concepts: List[str]
+    related_concepts: Tuple[str, ...]
     final_decision: str
 
 
@@ -72,20 +88,92 @@ class PerceptionModule:
         )
         return vector
 
+    def process_batch(self, raw_batch: Sequence[Dict[str, float]]) -> VectorBatch:
+        """Encode many inputs at once (see ``VectorBatch``)."""
+        if _np is None:
+            return [self.process(raw_data) for raw_data in raw_batch]
+        rows = [
+            (raw_data.get("feature1", 0.0), raw_data.get("feature2", 0.0), raw_data.get("urgency", 0.0))
+            for raw_data in raw_batch
+        ]
+        return _np.array(rows, dtype=_np.float64).reshape(-1, 3)
 
-class MemoryModule:
-    """Simulate M2 with a surprise-based short term memory buffer."""
 
-    def __init__(self) -> None:
-        self.short_term_memory: List[Vector3] = []
-
-    def process(self, perception_vector: Vector3) -> str:
-        surprise_factor = math.sqrt(sum(component ** 2 for component in perception_vector))
+class MemoryModule:
+    """Simulate M2 with a surprise-based short term memory buffer.
+
+    The STM is a fixed-capacity ring buffer: once full, the oldest entries are
+    overwritten. With NumPy it is a ``(capacity, 3)`` float64 array (matching the
+    Python floats ``process`` stores and thresholds) so queries over all stored
+    vectors are single vectorised operations. The array is allocated on the
+    first store, so modules that never see a high-surprise input stay cheap.
+    """
+
+    CAPACITY = 1024
+
+    def __init__(self, capacity: int = CAPACITY) -> None:
+        self.capacity = capacity
+        if _np is not None:
+            self._stm = None
+            self._head = 0
+            self._size = 0
+        else:
+            self._stm = deque(maxlen=capacity)
+
+    @property
+    def short_term_memory(self) -> List[Vector3]:
+        """Stored vectors, oldest first."""
+        if _np is None:
+            return list(self._stm)
+        if self._stm is None:
+            return []
+        start = (self._head - self._size) % self.capacity
+        order = (start + _np.arange(self._size)) % self.capacity
+        return [tuple(row) for row in self._stm[order].tolist()]
+
+    def _remember(self, perception_vector: Vector3) -> None:
+        if _np is None:
+            self._stm.append(perception_vector)
+            return
+        if self._stm is None:
+            self._stm = _np.empty((self.capacity, 3), dtype=_np.float64)
+        self._stm[self._head] = perception_vector
+        self._head = (self._head + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+
+    def high_surprise_entries(self, threshold: float) -> List[Vector3]:
+        """Return stored vectors whose surprise factor exceeds ``threshold``."""
+        if _np is None:
+            return [vector for vector in self._stm if math.hypot(*vector) > threshold]
+        if self._stm is None:
+            return []
+        # Unordered slots are fine here: filled slots are exactly the first _size rows
+        # until the buffer wraps, after which every slot is filled
+        filled = self._stm[: self._size]
+        return [tuple(row) for row in filled[_np.linalg.norm(filled, axis=1) > threshold].tolist()]
+
+    @staticmethod
+    def surprise_factors(perception_vectors: VectorBatch) -> List[float]:
+        """Return the surprise factor (L2 norm) of every row in a batch."""
+        if _np is not None:
+            vectors = _np.asarray(perception_vectors, dtype=_np.float64).reshape(-1, 3)
+            return _np.linalg.norm(vectors, axis=1).tolist()
+        return [math.hypot(*vector) for vector in perception_vectors]
+
+    @staticmethod
+    def status(surprise_factor: float) -> str:
+        """Describe what ``process`` does for the given surprise factor."""
         if surprise_factor > 1.0:
-            self.short_term_memory.append(perception_vector)
             return f"High surprise ({surprise_factor:.2f}). Stored in STM."
         return f"Low surprise ({surprise_factor:.2f}). Ignored."
 
+    def process(self, perception_vector: Vector3) -> str:
+        # math.hypot stays in C; NumPy only pays off for batches (surprise_factors)
+        surprise_factor = math.hypot(*perception_vector)
+        if surprise_factor > 1.0:
+            self._remember(perception_vector)
+        return self.status(surprise_factor)
+
 
 @dataclass
 class AbstractionModule:
@@ -98,6 +186,18 @@ class AbstractionModule:
             return "CONCEPT_ANALYTICAL_INPUT"
         return "CONCEPT_BACKGROUND_NOISE"
 
+    def process_batch(self, perception_vectors: VectorBatch) -> List[str]:
+        """Map every row of a batch to its concept with the same rules as ``process``."""
+        if _np is None:
+            return [self.process(vector) for vector in perception_vectors]
+        vectors = _np.asarray(perception_vectors, dtype=_np.float64).reshape(-1, 3)
+        concepts = _np.where(
+            vectors[:, 2] > 0.8,
+            "CONCEPT_URGENT_TASK",
+            _np.where(vectors[:, 0] > vectors[:, 1], "CONCEPT_ANALYTICAL_INPUT", "CONCEPT_BACKGROUND_NOISE"),
+        )
+        return concepts.tolist()
+
 
 class ReasoningModule:
     """Simulate M4 reasoning over a lightweight knowledge graph."""
@@ -114,23 +214,16 @@ class ReasoningModule:
                 ]
             )
             self._graph = graph
-            self._adjacency: Dict[str, List[str]] | None = None
+            # Snapshot neighbours once so process() is a plain dict lookup
+            self._adjacency: Mapping[str, Tuple[str, ...]] = MappingProxyType(
+                {node: tuple(graph.neighbors(node)) for node in graph.nodes}
+            )
         else:
             self._graph = None
-            self._adjacency = {
-                "CONCEPT_URGENT_TASK": ["ACTION_ALLOCATE_RESOURCES", "NOTIFY_SUPERVISOR"],
-                "CONCEPT_ANALYTICAL_INPUT": ["ACTION_RUN_ANALYSIS"],
-                "ACTION_RUN_ANALYSIS": ["SAVE_RESULTS"],
-            }
-
-    def process(self, concept: str) -> List[str]:
-        if self._graph is not None and _nx is not None:
-            if self._graph.has_node(concept):
-                return list(self._graph.neighbors(concept))
-        elif self._adjacency is not None:
-            if concept in self._adjacency:
-                return list(self._adjacency[concept])
-        return ["No related concepts found."]
+            self._adjacency = _KNOWLEDGE_GRAPH
+
+    def process(self, concept: str) -> Tuple[str, ...]:
+        return self._adjacency.get(concept, _NOT_FOUND)
 
 
 @dataclass
@@ -138,10 +231,11 @@ class AgencyModule:
     """Simulate M5 action selection with a simple priority scheme."""
 
     def process(self, potential_actions: Iterable[str]) -> str:
+        # Materialise once so generators survive the fallback branch
         actions = list(potential_actions)
-        for action in actions:
-            if action.startswith("ACTION_"):
-                return f"Decision: Execute '{action}'."
+        hit = next((action for action in actions if action.startswith("ACTION_")), None)
+        if hit is not None:
+            return f"Decision: Execute '{hit}'."
         if actions:
             return f"Decision: Fallback to '{actions[0]}'."
         return "Decision: No action required."
@@ -153,18 +247,26 @@ def _format_vector(perception_vector: Sequence[float]) -> str:
     return f"({perception_vector[0]:.2f}, {perception_vector[1]:.2f}, {perception_vector[2]:.2f})"
 
 
+@functools.lru_cache(maxsize=1)
+def _get_pipeline() -> Tuple[PerceptionModule, AbstractionModule, ReasoningModule, AgencyModule]:
+    """Build the stateless modules once; the knowledge graph is not rebuilt per trace."""
+    return PerceptionModule(), AbstractionModule(), ReasoningModule(), AgencyModule()
+
+
 def run_cognitive_trace(
     input_data: Dict[str, float],
     *,
     emit_console: bool = True,
-    delay_seconds: float = 0.5,
+    delay_seconds: float = 0.0,
 ) -> CognitiveTraceResult:
-    """Run the TITANS pipeline for the provided input data."""
-    m1 = PerceptionModule()
+    """Run the TITANS pipeline for the provided input data.
+
+    ``delay_seconds`` pauses between printed steps; it defaults to no delay so
+    programmatic and batch callers are not slowed down by the demo pacing.
+    """
+    m1, m3, m4, m5 = _get_pipeline()
+    # Memory holds per-trace state, so every trace still starts with an empty STM
     m2 = MemoryModule()
-    m3 = AbstractionModule()
-    m4 = ReasoningModule()
-    m5 = AgencyModule()
 
     perception_vector = m1.process(input_data)
     memory_status = m2.process(perception_vector)
@@ -236,6 +338,37 @@ def run_cognitive_trace(
     )
 
 
+def run_cognitive_trace_batch(input_batch: Sequence[Dict[str, float]]) -> List[CognitiveTraceResult]:
+    """Run many independent traces at once, without console output.
+
+    Perception, surprise and abstraction are computed for the whole batch in a
+    few NumPy calls; reasoning and agency run once per distinct concept. Each
+    result equals ``run_cognitive_trace(input_data, emit_console=False)``.
+    """
+    m1, m3, m4, m5 = _get_pipeline()
+
+    vectors = m1.process_batch(input_batch)
+    surprise = MemoryModule.surprise_factors(vectors)
+    concepts = m3.process_batch(vectors)
+    related: Dict[str, Tuple[Tuple[str, ...], str]] = {}
+    for concept in set(concepts):
+        concepts_for = m4.process(concept)
+        related[concept] = (concepts_for, m5.process(concepts_for))
+
+    rows = vectors.tolist() if _np is not None else vectors
+    return [
+        CognitiveTraceResult(
+            perception_vector=tuple(row),
+            # Every trace starts with an empty STM, so only the status is observable
+            memory_status=MemoryModule.status(factor),
+            abstract_concept=concept,
+            related_concepts=related[concept][0],
+            final_decision=related[concept][1],
+        )
+        for row, factor, concept in zip(rows, surprise, concepts)
+    ]
+
+
 def main() -> None:
     scenarios = {
         "Scenario 1: Urgent task": {"feature1": 0.5, "feature2": 0.3, "urgency": 0.9},
@@ -244,7 +377,7 @@ def main() -> None:
 
     for title, payload in scenarios.items():
         print(f"\n\n--- {title.upper()} ---")
-        run_cognitive_trace(payload, emit_console=True)
+        run_cognitive_trace(payload, emit_console=True, delay_seconds=0.5)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,15 @@
 # Minimal cognitive-step logger (single-process, file-backed). Python 3.10+
 
-import os, json, time, sqlite3, hashlib
+import os, json, math, time, sqlite3, hashlib, struct, threading
 from dataclasses import dataclass, asdict
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
 from pathlib import Path
 
+try:  # optional C encoder for the JSONL lines; stdlib json otherwise
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
 DATA_DIR = Path("./data")
 DATA_DIR.mkdir(exist_ok=True)
 LOG_JSONL = DATA_DIR / "steps.jsonl"
@@ -47,64 +52,160 @@ class Step:
     prev_hash: Optional[str] = None
     hash: Optional[str] = None
 
+_TS = struct.Struct("<d")
+_LEN = struct.Struct("<I")
+
+def _canonical_json(obj: Dict[str, Any]) -> bytes:
+    # stdlib on purpose: the hash must not depend on whether orjson is installed
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
 def step_hash(s: Step) -> str:
-    b = json.dumps({
-        "ts": s.ts, "trace_id": s.trace_id, "source": s.source, "event": s.event,
-        "payload": s.payload, "metrics": s.metrics, "prev_hash": s.prev_hash
-    }, sort_keys=True).encode("utf-8")
-    return hashlib.sha256(b).hexdigest()
+    # fixed fields are packed directly; only the free-form dicts go through JSON
+    h = hashlib.sha256(_TS.pack(s.ts))
+    for field in (s.trace_id, s.source, s.event, s.prev_hash or ""):
+        b = field.encode("utf-8")
+        h.update(_LEN.pack(len(b))); h.update(b)
+    h.update(_canonical_json(s.payload)); h.update(_canonical_json(s.metrics))
+    return h.hexdigest()
+
+def _non_finite(obj: Any) -> bool:
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_non_finite(k) or _non_finite(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return any(_non_finite(v) for v in obj)
+    return False
+
+def _jsonl_line(s: Step) -> bytes:
+    # orjson writes NaN/Infinity as null, which would no longer re-hash to s.hash;
+    # anything it cannot encode (e.g. ints beyond 64 bits) also goes through stdlib json
+    if orjson is not None and not (_non_finite(s.ts) or _non_finite(s.payload) or _non_finite(s.metrics)):
+        try:
+            return orjson.dumps(s, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            pass
+    return (json.dumps(asdict(s), ensure_ascii=False) + "\n").encode("utf-8")
 
 # --- Append-only log + index ---
+# One long-lived connection in autocommit mode; transactions are opened explicitly per trace
+_CONN: Optional[sqlite3.Connection] = None
+# trace_id -> hash of its most recent step, so chaining does not need a SELECT
+_LAST_HASH: Dict[str, str] = {}
+# Unbuffered JSONL handle kept open for the process; _OFFSET mirrors its end so no tell() is needed
+_LOG_FH = None
+_OFFSET = 0
+# Serialises all use of the shared connection, file offset and hash cache across threads
+# (reentrant: run_step holds it while calling latest_hash/append_steps)
+_LOCK = threading.RLock()
+
 def ensure_db():
-    conn = sqlite3.connect(DB_SQLITE)
-    c = conn.cursor()
-    c.execute("""CREATE TABLE IF NOT EXISTS steps(
+    with _LOCK:
+        return _ensure_db()
+
+def _ensure_db():
+    global _CONN, _LOG_FH, _OFFSET
+    if _LOG_FH is None:
+        _LOG_FH = open(LOG_JSONL, "ab", buffering=0)
+        _OFFSET = _LOG_FH.tell()
+    if _CONN is None:
+        _CONN = sqlite3.connect(DB_SQLITE, isolation_level=None, check_same_thread=False)
+        # WAL + NORMAL: commits append to the WAL without an fsync per transaction
+        _CONN.execute("PRAGMA journal_mode=WAL")
+        _CONN.execute("PRAGMA synchronous=NORMAL")
+        _CONN.execute("PRAGMA temp_store=MEMORY")
+    _CONN.execute("""CREATE TABLE IF NOT EXISTS steps(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         ts REAL, trace_id TEXT, source TEXT, event TEXT,
         hash TEXT UNIQUE, prev_hash TEXT, offset INTEGER
     )""")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_trace ON steps(trace_id)")
-    conn.commit(); conn.close()
+    _CONN.execute("CREATE INDEX IF NOT EXISTS idx_trace ON steps(trace_id)")
+    return _CONN
 
-def append_step(s: Step):
+def _db() -> sqlite3.Connection:
+    return _CONN if _CONN is not None else _ensure_db()
+
+def _write_lines(bufs: List[bytes]):
+    # normally one writev for the whole batch; after a short write only the unwritten tail is resent
+    fd = _LOG_FH.fileno()
+    pending = list(bufs)
+    while pending:
+        n = os.writev(fd, pending) if hasattr(os, "writev") else os.write(fd, pending[0])
+        while pending and n >= len(pending[0]):
+            n -= len(pending[0]); pending.pop(0)
+        if n:
+            pending[0] = memoryview(pending[0])[n:]
+
+def append_steps(steps: List[Step], fsync: bool = False):
+    with _LOCK:
+        _append_steps(steps, fsync)
+
+def _append_steps(steps: List[Step], fsync: bool = False):
+    global _OFFSET
+    conn = _db()
     # append JSONL
-    line = json.dumps(asdict(s), ensure_ascii=False)
-    with open(LOG_JSONL, "ab") as f:
-        off = f.tell()
-        f.write((line + "\n").encode("utf-8"))
-    # index
-    conn = sqlite3.connect(DB_SQLITE)
-    c = conn.cursor()
-    c.execute("INSERT INTO steps(ts, trace_id, source, event, hash, prev_hash, offset) VALUES(?,?,?,?,?,?,?)",
-              (s.ts, s.trace_id, s.source, s.event, s.hash, s.prev_hash, off))
-    conn.commit(); conn.close()
+    bufs, rows = [], []
+    off = _OFFSET
+    for s in steps:
+        b = _jsonl_line(s)
+        bufs.append(b)
+        rows.append((s.ts, s.trace_id, s.source, s.event, s.hash, s.prev_hash, off))
+        off += len(b)
+    _write_lines(bufs)
+    if fsync:
+        os.fsync(_LOG_FH.fileno())
+    _OFFSET = off
+    # index: one transaction per batch
+    conn.execute("BEGIN")
+    try:
+        conn.executemany("INSERT INTO steps(ts, trace_id, source, event, hash, prev_hash, offset) VALUES(?,?,?,?,?,?,?)",
+                         rows)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    for s in steps:
+        _LAST_HASH[s.trace_id] = s.hash
+
+def append_step(s: Step):
+    append_steps([s])
 
 def latest_hash(trace_id: str) -> Optional[str]:
-    conn = sqlite3.connect(DB_SQLITE); c = conn.cursor()
-    c.execute("SELECT hash FROM steps WHERE trace_id=? ORDER BY id DESC LIMIT 1", (trace_id,))
-    row = c.fetchone(); conn.close()
+    with _LOCK:
+        return _latest_hash(trace_id)
+
+def _latest_hash(trace_id: str) -> Optional[str]:
+    if trace_id in _LAST_HASH:
+        return _LAST_HASH[trace_id]
+    # cold cache (e.g. new process): fall back to the index once
+    row = _db().execute("SELECT hash FROM steps WHERE trace_id=? ORDER BY id DESC LIMIT 1", (trace_id,)).fetchone()
+    if row:
+        _LAST_HASH[trace_id] = row[0]
     return row[0] if row else None
 
 # --- One cognitive step run ---
 def run_step(trace_id: str, x: str):
-    prev = latest_hash(trace_id)
+    # held for the whole trace so concurrent runs on one trace_id cannot fork the hash chain
+    with _LOCK:
+        return _run_step(trace_id, x)
+
+def _run_step(trace_id: str, x: str):
+    prev = _latest_hash(trace_id)
     # M1
     p = m1_perception(x)
     s1 = Step(time.time(), trace_id, "M1", "PERCEPT", p, {"dt_ms": 0.0}, prev_hash=prev); s1.hash = step_hash(s1)
-    append_step(s1)
     # M3
     a = m3_abstraction(p)
     s2 = Step(time.time(), trace_id, "M3", "ABSTRACT", a, {"dt_ms": 0.0}, prev_hash=s1.hash); s2.hash = step_hash(s2)
-    append_step(s2)
     # M4
     r = m4_reasoning(a)
     s3 = Step(time.time(), trace_id, "M4", "REASON", r, {"dt_ms": 0.0}, prev_hash=s2.hash); s3.hash = step_hash(s3)
-    append_step(s3)
     # M5
     act = m5_agency(r, x)
     s4 = Step(time.time(), trace_id, "M5", "ACT", act, {"dt_ms": 0.0, "delta_uncertainty": act["delta_uncertainty"]},
               prev_hash=s3.hash); s4.hash = step_hash(s4)
-    append_step(s4)
+    # all four steps: one writev, one fsync at the trace boundary, one DB transaction
+    _append_steps([s1, s2, s3, s4], fsync=True)
     return act["output"]
 
 if __name__ == "__main__":